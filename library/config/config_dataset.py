@@ -51,6 +51,12 @@ def get_config_stft():
         noverlap = 40,
         # window = ('gaussian', 1),
         window = 'hann',
+        # Boundary extension and padding of the signal (as in scipy.signal.stft). Use boundary = None and padded = False to compute the stft only inside the trial
+        boundary = 'zeros',
+        padded = True,
+        # Backend for the stft computation. If use_torch is True the stft is computed through torch.stft on the specified device
+        use_torch = False,
+        device = 'cuda',
     )
 
     return config
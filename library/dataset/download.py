@@ -7,8 +7,11 @@ Function related to download the data
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 #%% Imports
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import mne
+from numba import njit, prange
 
 import moabb.datasets as mb
 import moabb.paradigms as mp
@@ -24,10 +27,11 @@ import download
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 # Download and automatic segmentation (moabb)
 
-def get_moabb_data_automatic(dataset, paradigm, config, type_dataset):
+def get_moabb_data_automatic(dataset, paradigm, config):
     """
     Return the raw data from the moabb package of the specified dataset and paradigm with some basic preprocess (implemented inside the library)
     This function utilize the moabb library to automatic divide the dataset in trials and for the baseline removal
+    The data of both sessions are returned, together with a numpy array with the session of each trial (use select_session to get the train or test data)
     N.b. dataset and paradigm must be object of the moabb library
     """
 
@@ -51,17 +55,22 @@ def get_moabb_data_automatic(dataset, paradigm, config, type_dataset):
     # Get the raw data
     raw_data, raw_labels, info = paradigm.get_data(dataset = dataset, subjects = config['subjects_list'])
     print(info)
-        
-    # Select train/test data
-    if type_dataset == 'train':
-        idx_type = info['session'].to_numpy() == 'session_T'
-    elif type_dataset == 'test':
-        idx_type = info['session'].to_numpy() == 'session_E'
 
-    raw_data = raw_data[idx_type]
-    raw_labels = raw_labels[idx_type]
+    # Session of each trial (the pandas column is converted only once)
+    session = info['session'].to_numpy()
+
+    return raw_data, raw_labels, session
+
+def select_session(raw_data, raw_labels, session, type_dataset):
+    """
+    Select the train (session_T) or test (session_E) data from the output of get_moabb_data_automatic
+    """
+    if type_dataset == 'train': session_to_keep = 'session_T'
+    elif type_dataset == 'test': session_to_keep = 'session_E'
+    else: raise ValueError("type_dataset must have value train or test")
+    idx_type = np.flatnonzero(session == session_to_keep)
 
-    return raw_data, raw_labels
+    return raw_data.take(idx_type, axis = 0), raw_labels.take(idx_type, axis = 0)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 # Download and  segmentation through mne 
@@ -71,33 +80,11 @@ def get_moabb_data_handmade(dataset, config, type_dataset):
     Download and preprocess dataset from moabb.
     The division in trials is not handle by the moabb library but by functions that I wrote 
     """
-    # Get the raw dataset for the specified list of subject
-    raw_dataset = dataset.get_data(subjects = config['subjects_list'])
-    
     # Used to save the data for each subject
     trials_per_subject = []
     labels_per_subject = []
     
-    # Iterate through subject
-    for subject in config['subjects_list']:
-        # Extract the data for the subject
-        raw_data = raw_dataset[subject]
-        
-        # For each subject the data are divided in train and test. Here I extract train or test data 
-        if type_dataset == 'train': raw_data = raw_data['session_T']
-        elif type_dataset == 'test': raw_data = raw_data['session_E']
-        else: raise ValueError("type_dataset must have value train or test")
-
-        trials_matrix, labels, ch_list = get_trial_handmade(raw_data, config)
-
-        # Select only the data channels
-        if 'BNCI2014001' in str(type(dataset)): # Dataset 2a BCI Competition IV
-            if 'channels_list' in config: idx_ch = get_idx_ch(ch_list, config)
-            else: idx_ch = np.arange(22)
-            
-            trials_matrix = trials_matrix[:, idx_ch, :]
-            ch_list = ch_list[idx_ch]
-            
+    for trials_matrix, labels, ch_list in iterate_moabb_data_handmade(dataset, config, type_dataset):
         # Save trials and labels for each subject
         trials_per_subject.append(trials_matrix)
         labels_per_subject.append(labels)
@@ -106,51 +93,98 @@ def get_moabb_data_handmade(dataset, config, type_dataset):
     trials_per_subject = np.asarray(trials_per_subject)
     labels_per_subject = np.asarray(labels_per_subject)
 
-    return trials_per_subject, labels_per_subject, np.asarray(ch_list) 
+    return trials_per_subject, labels_per_subject, ch_list
+
+def iterate_moabb_data_handmade(dataset, config, type_dataset):
+    """
+    Generator version of get_moabb_data_handmade. For each subject inside config['subjects_list'] yield the trials matrix, the labels and the list of channels.
+    Only the data of the actual subject (and the raw data of the next one) are kept in memory.
+    """
+    subjects_list = config['subjects_list']
+
+    # For each subject the data are divided in train and test. Here I select the session with train or test data 
+    # N.b. the check is done before starting to load the data
+    if type_dataset == 'train': session = 'session_T'
+    elif type_dataset == 'test': session = 'session_E'
+    else: raise ValueError("type_dataset must have value train or test")
+
+    # Check the dataset only once (for the dataset 2a only the eeg channels are kept)
+    select_eeg_channels = isinstance(dataset, mb.BNCI2014001) # Dataset 2a BCI Competition IV
+    idx_ch = None
+    
+    # The raw data of each subject are loaded in a separate thread.
+    # In this way the data of the next subject are read from disk while the actual subject is processed
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        future_raw_dataset = executor.submit(dataset.get_data, subjects = [subjects_list[0]])
+    
+        # Iterate through subject
+        for i in range(len(subjects_list)):
+            subject = subjects_list[i]
+
+            # Get the raw dataset of the actual subject and start to load the next one
+            raw_dataset = future_raw_dataset.result()
+            if i + 1 < len(subjects_list): future_raw_dataset = executor.submit(dataset.get_data, subjects = [subjects_list[i + 1]])
+
+            # Extract the train or test data for the subject
+            raw_data = raw_dataset[subject][session]
+
+            trials_matrix, labels, ch_list = get_trial_handmade(raw_data, config)
+
+            # Select only the data channels (the indices are the same for all the subjects)
+            if select_eeg_channels:
+                if idx_ch is None:
+                    if 'channels_list' in config: idx_ch = get_idx_ch(ch_list, config)
+                    else: idx_ch = np.arange(22)
+            
+                trials_matrix = trials_matrix[:, idx_ch, :]
+                ch_list = ch_list[idx_ch]
+            
+            yield trials_matrix, labels, ch_list
 
 def get_trial_handmade(raw_data, config):
-    trials_matrix_list = []
-    label_list = []
-    n_trials = 0
+    # First pass: extract label and events position of each run
+    # Note that the events mark the start of a trial
+    events_per_run = {run : get_events(raw_data[run]) for run in raw_data}
 
-    # Iterate through the run of the dataset
+    # Total number of trials (i.e. events) of all the runs and the labels of all the trials
+    n_trials_total = sum(len(events) for events, _ in events_per_run.values())
+    labels = np.concatenate([raw_labels for _, raw_labels in events_per_run.values()], axis = 0)
+    
+    # Get the sampling frequency and the list of channels (they are the same for all the runs)
+    first_run = raw_data[next(iter(raw_data))]
+    sampling_freq = first_run.info['sfreq']
+    config['sampling_freq'] = sampling_freq
+    ch_list = np.asarray(first_run.ch_names)
+
+    # Allocate the matrix for the trials of all runs
+    trial_length = int(sampling_freq * config['trial_end']) - int(sampling_freq * config['trial_start'])
+    trials_matrix = np.empty((n_trials_total, len(ch_list), trial_length), dtype = np.float32)
+
+    # Parameters of the iir filter (computed only once since all the runs have the same sampling frequency)
+    if config['filter_data'] and config['filter_method'] == 'iir': iir_params = get_iir_params(config, sampling_freq)
+    else: iir_params = None
+    
+    # Second pass: iterate through the run of the dataset and fill the trials matrix
+    n_trials = 0
     for run in raw_data:
         print(run)
         # Extract data actual run
         raw_data_actual_run = raw_data[run]
-
-        # Extract label and events position
-        # Note that the events mark the start of a trial
-        raw_info = mne.find_events(raw_data_actual_run)
-        events = raw_info[:, 0]
-        raw_labels = raw_info[:, 2]
-        # print(raw_info, "\n")
+        events, _ = events_per_run[run]
         
-        # Get the sampling frequency
-        sampling_freq = raw_data_actual_run.info['sfreq']
-        config['sampling_freq'] = sampling_freq
+        # Get the data of the actual run
+        run_data = raw_data_actual_run.get_data()
         
         # (OPTIONAL) Filter data
-        if config['filter_data']: raw_data_actual_run = filter_RawArray(raw_data_actual_run, config)
+        if config['filter_data']: run_data = filter_run_data(run_data, raw_data_actual_run.info, config, iir_params)
 
-        # Compute trials by events
-        trials_matrix_actual_run = divide_by_event(raw_data_actual_run, events, config)
+        # Compute trials by events (the trials are saved directly inside trials_matrix)
+        divide_by_event(run_data, events, config, trials_matrix[n_trials:n_trials + len(events)])
 
-        # Save trials and the corresponding label
-        trials_matrix_list.append(trials_matrix_actual_run)
-        label_list.append(raw_labels)
-        
         # Compute the total number of trials 
-        n_trials += len(raw_labels)
-    
-    # Convert list in numpy array
-    trials_matrix = np.asarray(trials_matrix_list)
-    labels = np.asarray(label_list)
-    
-    trials_matrix.resize(n_trials, trials_matrix.shape[2], trials_matrix.shape[3])
-    labels.resize(n_trials)
+        n_trials += len(events)
 
-    return trials_matrix, labels, np.asarray(raw_data_actual_run.ch_names)
+    return trials_matrix, labels, ch_list
 
 def filter_RawArray(raw_array_mne, config):
     # Filter the data
@@ -168,28 +202,89 @@ def filter_RawArray(raw_array_mne, config):
 
     return raw_array_mne
 
-def divide_by_event(raw_run, events, config):
+def get_events(raw_run):
     """
-    Divide the actual run in trials based on the indices inside the events array
+    Get the events of the run directly from the stim channel. An event is the sample where the value of the stim channel increases.
+    The results are the same of mne.find_events with the default parameters (i.e. only the onset of the events and no initial event).
+    Return the position (index of the sample) and the value of each event
     """
-    run_data = raw_run.get_data()
-    trials_list = []
-    for i in range(len(events)):
-        # Extract the data between the two events (i.e. the trial plus some data during the rest between trials)
-        if i == len(events) - 1:
-            trial = run_data[:, events[i]:-1]
-        else:
-            trial = run_data[:, events[i]:events[i + 1]]
-        
-        # Extract the current trial
-        actual_trial = trial[:, int(config['sampling_freq'] * config['trial_start']):int(config['sampling_freq'] * config['trial_end'])]
-        trials_list.append(actual_trial)
+    # N.b. the indices of the channel are used since for the dataset 2a the name of the stim channel is also 'stim'
+    idx_stim = mne.pick_types(raw_run.info, meg = False, stim = True)[0]
+    stim = raw_run.get_data(picks = [idx_stim])[0]
+
+    events = np.flatnonzero(np.diff(stim) > 0) + 1
+    events_value = stim[events].astype(int)
+
+    return events, events_value
+
+def get_filter_band(config):
+    """
+    Return the low and high cut frequency of the filter specified in the config (None means no cut)
+    """
+    if config['filter_type'] == 0: # Bandpass
+        return config['fmin'], config['fmax']
+    if config['filter_type'] == 1: # Lowpass
+        return None, config['fmax']
+    if config['filter_type'] == 2: # Highpass 
+        return config['fmin'], None
+
+def get_iir_params(config, sampling_freq):
+    """
+    Design the iir filter specified in the config and return the iir_params dictionary of mne with the second order sections (sos) of the filter.
+    If this dictionary is passed to mne the filter is not designed again.
+    """
+    l_freq, h_freq = get_filter_band(config)
+    iir_params = dict(config['iir_params'], output = 'sos')
+
+    return mne.filter.create_filter(None, sampling_freq, l_freq, h_freq, method = 'iir', iir_params = iir_params)
+
+def filter_run_data(run_data, info, config, iir_params = None):
+    """
+    Filter the eeg channels of a run. run_data is the numpy array with the data of the run (shape C x T) and info the mne info of the run.
+    If the iir_params are not passed the ones inside the config are used (i.e. the filter is designed during the call)
+    """
+    l_freq, h_freq = get_filter_band(config)
+    if iir_params is None: iir_params = config['iir_params']
+    
+    # Filter only the eeg channels (as the filter method of the mne RawArray)
+    picks = mne.pick_types(info, eeg = True, exclude = [])
+
+    return mne.filter.filter_data(run_data, info['sfreq'], l_freq, h_freq, picks = picks, 
+                                  method = config['filter_method'], iir_params = iir_params)
+
+def divide_by_event(run_data, events, config, trials_matrix = None):
+    """
+    Divide the actual run in trials based on the indices inside the events array. run_data is the numpy array with the data of the run (shape C x T)
+    If trials_matrix is passed the trials are saved inside it (it must have shape n_events x C x trial length) otherwise a new matrix is allocated
+    """
+    # Indices of start and end of the trial with respect to the event
+    idx_start = int(config['sampling_freq'] * config['trial_start'])
+    idx_end = int(config['sampling_freq'] * config['trial_end'])
+
+    if trials_matrix is None: trials_matrix = np.empty((len(events), run_data.shape[0], idx_end - idx_start), dtype = np.float32) 
     
+    # Check that all the trials are inside the run (the numba kernel does not check the indices)
+    events = np.asarray(events, dtype = np.int64)
+    idx_outside_run = np.flatnonzero(np.logical_or(events + idx_start < 0, events + idx_end > run_data.shape[1]))
+    if len(idx_outside_run) > 0:
+        raise ValueError("The trials of the events {} (samples {}) are outside the run. The run has {} samples and each trial goes from {} to {} samples after the event".format(
+            idx_outside_run, events[idx_outside_run], run_data.shape[1], idx_start, idx_end))
+    
+    # Extract the trials
     # The 1e6 factor is used to scale the input signal (the original signal is in microvolt)
-    trials_matrix = np.asarray(trials_list) * 1e6
+    # The trials are saved in single precision
+    divide_by_event_numba(np.ascontiguousarray(run_data), events, idx_start, idx_end, 1e6, trials_matrix)
 
     return trials_matrix
 
+@njit(cache = True, parallel = True)
+def divide_by_event_numba(run_data, events, idx_start, idx_end, scale, trials_matrix):
+    """
+    Copy each trial (i.e. the samples between idx_start and idx_end after each event) inside trials_matrix
+    """
+    for i in prange(len(events)):
+        trials_matrix[i] = run_data[:, events[i] + idx_start:events[i] + idx_end] * scale
+
 def get_idx_ch(ch_list_dataset, config):
     """
     Function to create a list of indices to select only specific channels
@@ -229,12 +324,8 @@ def get_D2a_data(config, type_dataset):
 
     # Get the data
     if config['use_moabb_segmentation']:
-        raw_data, raw_labels = get_moabb_data_automatic(dataset, paradigm, config, type_dataset)
-        
-        # Select channels and convert labels
-        # N.b. since for now we work only with dataset 2a I hardcode the 22 channels selection
-        data = raw_data[:, 0:22, :]
-        labels = convert_label(raw_labels)
+        raw_data, raw_labels, session = get_moabb_data_automatic(dataset, paradigm, config)
+        data, labels = convert_moabb_data_automatic(*select_session(raw_data, raw_labels, session, type_dataset))
 
         ch_list = get_dataset_channels(dataset)[0:22]
     else:
@@ -251,12 +342,47 @@ def get_D2a_data(config, type_dataset):
 
     return data, labels.squeeze(), ch_list
 
+def get_D2a_data_train_test(config):
+    """
+    Return both train and test data (data_train, labels_train, data_test, labels_test, ch_list). 
+    With the moabb segmentation the dataset is divided in trials only once for both sessions.
+    """
+    if config['use_moabb_segmentation']:
+        check_config.check_config_dataset(config)
+        
+        # Select the dataset and the paradigm (i.e. the object to download the dataset)
+        dataset = mb.BNCI2014001()
+        paradigm = mp.MotorImagery()
+
+        # Get the data of both sessions
+        raw_data, raw_labels, session = get_moabb_data_automatic(dataset, paradigm, config)
+        data_train, labels_train = convert_moabb_data_automatic(*select_session(raw_data, raw_labels, session, 'train'))
+        data_test, labels_test = convert_moabb_data_automatic(*select_session(raw_data, raw_labels, session, 'test'))
+
+        ch_list = get_dataset_channels(dataset)[0:22]
+    else:
+        # With the "handmade" division the data of each session are loaded separately
+        data_train, labels_train, ch_list = get_D2a_data(config, 'train')
+        data_test, labels_test, ch_list = get_D2a_data(config, 'test')
+
+    return data_train, labels_train, data_test, labels_test, ch_list
+
+def convert_moabb_data_automatic(raw_data, raw_labels):
+    """
+    Select the channels and convert the labels of the data obtained with get_moabb_data_automatic
+    """
+    # N.b. since for now we work only with dataset 2a I hardcode the 22 channels selection
+    data = raw_data[:, 0:22, :]
+    labels = convert_label(raw_labels)
+
+    return data, labels.squeeze()
+
 def get_dataset_channels(dataset):
     """
     Get the list of channels for the specific dataset
     """
 
-    if 'BNCI2014001' in str(type(dataset)): # Dataset 2a BCI Competition IV
+    if isinstance(dataset, mb.BNCI2014001): # Dataset 2a BCI Competition IV
         raw_data = dataset.get_data(subjects=[1])[1]['session_T']['run_0']
         ch_list = raw_data.ch_names
     else:
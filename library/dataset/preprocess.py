@@ -7,10 +7,14 @@ Function related to download the data, their preprocessing and basic visualizati
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 #%% Imports
 
+import functools
+
 import numpy as np
 import matplotlib.pyplot as plt
 import mne
 from scipy import signal
+import scipy.fft
+import torch
 
 import moabb.datasets as mb
 import moabb.paradigms as mp
@@ -30,6 +34,10 @@ from . import support_function as sf
 import preprocess as pp
 """
 
+# Maximum size (in bytes) of all the temporary matrices allocated by compute_stft for a block of trials (windowed segments, complex stft and, for the power, the scratch buffer). 
+# The trials are divided in blocks that fit in this size
+_MAX_MEM_BLOCK = 2**30
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 # Preprocess
@@ -41,27 +49,89 @@ def baseline_removal(trials_matrix, config : dict):
 
     return stft_trials_matrix_ERS, t_trial, f
 
-def compute_stft(trials_matrix, config : dict):
+def compute_stft(trials_matrix, config : dict, return_power : bool = True):
     """
-    Compute the stft of the trials matrix channel by channel
+    Compute the stft of the trials matrix.
+    If return_power is True the power of the stft (i.e. the squared magnitude) is returned, otherwise the complex stft.
+    The stft is computed for all the trials and channels together, applying the rfft to a (zero-copy) view of the windowed segments.
+    The results are the same of scipy.signal.stft with the boundary and padded parameters specified inside config['stft_parameters'].
+    With boundary = None and padded = False only the segments inside the trial are used and the trials are not copied to be padded.
     """
+    # Work in single precision. The output of the rfft will be complex64 instead of complex128
+    trials_matrix = np.ascontiguousarray(trials_matrix, dtype = np.float32)
+
+    fs = config['stft_parameters']['sampling_freq']
+    nperseg = config['stft_parameters']['nperseg']
+    hop = nperseg - config['stft_parameters']['noverlap']
+
+    # Window used for the stft (computed only once for each combination of window and nperseg)
+    win = get_stft_window(config['stft_parameters']['window'], nperseg)
+
+    # (OPTIONAL) Extend the signal with zeros at both ends 
+    # N.b. the default values (the same of scipy.signal.stft) are used for configs created without boundary and padded (e.g. the ones of old wandb runs)
+    boundary = config['stft_parameters'].get('boundary', 'zeros')
+    if boundary == 'zeros': n_pad_boundary = nperseg // 2
+    elif boundary is None: n_pad_boundary = 0
+    else: raise ValueError("boundary must have value 'zeros' or None")
+    
+    # (OPTIONAL) Pad the end so that the last segment is complete
+    n_samples = trials_matrix.shape[-1] + 2 * n_pad_boundary
+    if config['stft_parameters'].get('padded', True): n_pad_end = (-(n_samples - nperseg) % hop) % nperseg
+    else: n_pad_end = 0
 
-    stft_trials_matrix = []
-
-    for i in range(trials_matrix.shape[0]): # Iterate through trials
-        stft_per_channels = []
-        for j in range(trials_matrix.shape[1]): # Iterate through channels
-            x = trials_matrix[i, j]
-            # Default
-            f, t, tmp_stft = signal.stft(x, fs = config['stft_parameters']['sampling_freq'], nperseg = config['stft_parameters']['nperseg'], 
-                                         window = config['stft_parameters']['window'], noverlap = config['stft_parameters']['noverlap'])
-            
-            stft_per_channels.append(np.power(np.abs(tmp_stft), 2))
-
-        stft_trials_matrix.append(stft_per_channels)
+    if n_pad_boundary > 0 or n_pad_end > 0:
+        x = np.pad(trials_matrix, [(0, 0)] * (trials_matrix.ndim - 1) + [(n_pad_boundary, n_pad_boundary + n_pad_end)])
+    else:
+        x = trials_matrix
+
+    # Number of segments (i.e. time samples) and frequency bins of the stft
+    # Each time sample is the center of the segment (without the boundary extension the first segment is centered in nperseg / 2)
+    n_segments = (x.shape[-1] - nperseg) // hop + 1
+    f = scipy.fft.rfftfreq(nperseg, 1 / fs)
+    t = np.arange(n_segments) * hop / fs
+    if n_pad_boundary == 0: t += (nperseg / 2) / fs
+
+    # Matrix to save the (power of the) stft. Shape N x C x F x T
+    stft_dtype = trials_matrix.dtype if return_power else np.result_type(trials_matrix.dtype, np.complex64)
+    stft_trials_matrix = np.empty(x.shape[:-1] + (len(f), len(t)), dtype = stft_dtype)
+
+    # Number of trials for each block. For each segment of each channel the temporary matrices are:
+    #   - the windowed segment (nperseg float32 values)
+    #   - the complex stft (F complex64 values)
+    #   - (only for the power) the scratch buffer for the imaginary part (F float32 values)
+    bytes_per_segment = nperseg * np.dtype(np.float32).itemsize + len(f) * np.dtype(np.complex64).itemsize
+    if return_power: bytes_per_segment += len(f) * np.dtype(np.float32).itemsize
+    bytes_per_trial = np.prod(x.shape[1:-1], dtype = int) * len(t) * bytes_per_segment
+    n_trials_per_block = int(max(1, _MAX_MEM_BLOCK // bytes_per_trial))
+
+    for bl_s in range(0, x.shape[0], n_trials_per_block):
+        bl_t = min(bl_s + n_trials_per_block, x.shape[0])
+
+        # Compute the stft of the block (shape N_block x C x T x F)
+        # N.b. configs created without use_torch (e.g. the ones of old wandb runs) use the numpy backend
+        if config['stft_parameters'].get('use_torch', False):
+            tmp_stft = compute_stft_torch(x[bl_s:bl_t], win, hop, config['stft_parameters']['device'])
+        else:
+            # View with the segments of the signal. Shape N_block x C x T x nperseg 
+            frames = np.lib.stride_tricks.sliding_window_view(x[bl_s:bl_t], nperseg, axis = -1)[..., ::hop, :]
+            # The fft of the segments are computed in parallel on all the cores (workers = -1)
+            tmp_stft = scipy.fft.rfft(frames * win, n = nperseg, axis = -1, workers = -1)
     
-    # Convert the list in a matrix
-    stft_trials_matrix = np.asarray(stft_trials_matrix)
+        # Save the stft directly inside the output matrix
+        stft_view = np.moveaxis(stft_trials_matrix[bl_s:bl_t], -2, -1)
+        if return_power:
+            # Power computed as real^2 + imag^2 (no square root as with the absolute value)
+            # The imaginary part is squared inside a scratch buffer, so no other temporary matrix is created
+            buffer_imag = np.empty(stft_view.shape, dtype = stft_view.dtype)
+            np.square(tmp_stft.real, out = stft_view)
+            np.square(tmp_stft.imag, out = buffer_imag)
+            np.add(stft_view, buffer_imag, out = stft_view)
+            del buffer_imag
+        else:
+            stft_view[...] = tmp_stft
+
+        # Free the temporary matrices before the computation of the next block (otherwise they are kept in memory together with the ones of the next block)
+        del tmp_stft
 
     # Remove the filtered frequencies
     if config['filter_data']: 
@@ -75,7 +145,58 @@ def compute_stft(trials_matrix, config : dict):
         idx_freq = np.ones(len(f)) == 1
     idx_freq = np.ones(len(f)) == 1
 
-    return stft_trials_matrix[:, :, idx_freq, :], t, f[idx_freq]
+    # N.b. the boolean indexing copies the whole stft matrix, so it is done only if some frequencies are removed
+    if not idx_freq.all(): stft_trials_matrix, f = stft_trials_matrix[:, :, idx_freq, :], f[idx_freq]
+
+    return stft_trials_matrix, t, f
+
+def get_stft_window(window, nperseg : int):
+    """
+    Return the window used by compute_stft (as in scipy.signal.stft the window amplitude is normalized by its sum)
+    window can be anything accepted by scipy.signal.get_window (e.g. 'hann' or ('gaussian', 1)) or an array with the values of the window.
+    Windows specified by name are cached, so they are computed only the first time they are requested for a specific nperseg
+    """
+    # Array with the values of the window (as in scipy.signal.stft its length must be nperseg). Not cached since arrays are not hashable
+    if isinstance(window, np.ndarray):
+        if window.shape != (nperseg, ): raise ValueError("The window must be a 1D array of length nperseg ({})".format(nperseg))
+        return normalize_stft_window(window)
+
+    # Lists (e.g. from the wandb config) are converted in tuple to be hashable
+    if isinstance(window, list): window = tuple(window)
+
+    return get_stft_window_cached(window, nperseg)
+
+@functools.lru_cache(maxsize = None)
+def get_stft_window_cached(window, nperseg : int):
+    win = normalize_stft_window(signal.get_window(window, nperseg))
+
+    # Avoid accidental modification of the cached window
+    win.flags.writeable = False
+
+    return win
+
+def normalize_stft_window(win):
+    return (win / win.sum()).astype(np.float32)
+
+def compute_stft_torch(x, win, hop, device):
+    """
+    Compute the stft of the (already padded) signals in x with torch.stft. All the signals are computed together as a single batch (e.g. with cuFFT if device is a GPU)
+    The output is a numpy array with shape ... x T x F, i.e. the same of the rfft applied to the windowed segments
+    """
+    nperseg = len(win)
+
+    # Merge all the axis except the time in a single batch axis
+    x_torch = torch.from_numpy(x).to(device).reshape(-1, x.shape[-1])
+    win_torch = torch.tensor(win, device = device)
+
+    # N.b. the boundary and the padding are already added to x so center is set to False
+    tmp_stft = torch.stft(x_torch, n_fft = nperseg, hop_length = hop, win_length = nperseg, window = win_torch, 
+                          center = False, onesided = True, return_complex = True)
+    
+    # Restore the original shape and move the time before the frequency (torch.stft return F x T)
+    tmp_stft = tmp_stft.reshape(x.shape[:-1] + tmp_stft.shape[-2:]).transpose(-1, -2)
+
+    return tmp_stft.cpu().numpy()
 
 def compute_ERS(stft_trials_matrix, t, f):
     # Indices for rest
@@ -100,7 +221,7 @@ def compute_ERS(stft_trials_matrix, t, f):
     return stft_trials_matrix_ERS, t
 
 def compute_ERS_single_channels(stft_channel, idx_rest):
-    stft_channel_ERS = np.zeros(stft_channel.shape)
+    stft_channel_ERS = np.zeros(stft_channel.shape, dtype = stft_channel.dtype)
 
     # Get the rest periodo and compute the average
     rest_period = stft_channel[:, idx_rest]
@@ -118,8 +239,7 @@ def compute_ERS_single_channels(stft_channel, idx_rest):
 
 def get_dataset_d2a(config : dict):
     # Get the original train and test data
-    data_train, labels_train, ch_list = download.get_D2a_data(config, 'train')
-    data_test, labels_test, ch_list = download.get_D2a_data(config, 'test')
+    data_train, labels_train, data_test, labels_test, ch_list = download.get_D2a_data_train_test(config)
     config['channels_list'] = ch_list
 
     if config['train_trials_to_keep'] is not None:
@@ -181,10 +301,9 @@ def download_preprocess_and_visualize():
     subjects_list = [3]
     show_fig = True 
 
-    # Download the dataset and divide it in trials
+    # Config to download the dataset
     dataset_config = cd.get_moabb_dataset_config(subjects_list)
     dataset = mb.BNCI2014001()
-    trials_per_subject, labels_per_subject, ch_list = download.get_moabb_data_handmade(dataset, dataset_config, 'train')
     
     # Config for the plots
     plot_config_random_trial = cp.get_config_plot_preprocess_random_trial() 
@@ -193,14 +312,13 @@ def download_preprocess_and_visualize():
     plot_config_random_trial['show_fig'] = plot_config_average_band['show_fig'] = plot_config_ERS['show_fig'] = show_fig
     plot_config_random_trial['t_end'] = plot_config_average_band['t_end'] = dataset_config['length_trial']
     
-    # Iterate through subject and show the figures
-    for i in range(trials_per_subject.shape[0]):
+    # Download the dataset, divide it in trials and show the figures one subject at a time
+    # In this way only the data of the actual subject are kept in memory
+    subjects_data = download.iterate_moabb_data_handmade(dataset, dataset_config, 'train')
+    for i, (trials, labels, ch_list) in enumerate(subjects_data):
         print("Subject: {}".format(subjects_list[i]))
         plot_config_random_trial['subject'] = plot_config_average_band['subject'] = plot_config_ERS['subject'] = subjects_list[i]
 
-        trials = trials_per_subject[i]
-        labels = labels_per_subject[i]
-
         # Visualize random trial in time domain
         # plot_random_trial_time_domain(trials, ch_list, plot_config_random_trial)
         
@@ -236,20 +354,19 @@ def show_filter_effect():
 
     plot_config_show_effect_filter = cp.get_config_plot_preprocess_random_trial() # The config for the plot are the same
 
-    # Download the dataset and divide it in trials
+    # Download the dataset and divide it in trials (one subject at a time)
     dataset_config = cd.get_moabb_dataset_config(subjects_list)
     dataset = mb.BNCI2014001()
-    trials_per_subject, labels_per_subject, ch_list = download.get_moabb_data_handmade(dataset, dataset_config, 'train')
+    subjects_data = download.iterate_moabb_data_handmade(dataset, dataset_config, 'train')
     
-    for i in range(trials_per_subject.shape[0]):
+    for i, (trials, labels, ch_list) in enumerate(subjects_data):
         print("Subject: {}".format(subjects_list[i]))
 
-        trials = trials_per_subject[i]
-        labels = labels_per_subject[i]
-
         plot_config_show_effect_filter['subject'] = subjects_list[i]
-        dataset_config['filter_data'] = True
-        pp_plot.show_filter_effect_on_trial(trials, ch_list, dataset_config, plot_config_show_effect_filter)
+        
+        # N.b. dataset_config is still used to load the next subjects (that must not be filtered) so a copy is modified
+        filter_config = dict(dataset_config, filter_data = True)
+        pp_plot.show_filter_effect_on_trial(trials, ch_list, filter_config, plot_config_show_effect_filter)
 
 def show_filter_effect_on_ERS():
     subjects_list = [1,2,3,4,5,6,7,8,9]
@@ -325,17 +442,14 @@ def show_after_before_ERS():
     plot_config = cp.get_config_plot_preprocess_random_trial() # The config for the plot are the same
     plot_config['cmap'] = 'Blues_r'
 
-    # Download the dataset and divide it in trials
+    # Download the dataset and divide it in trials (one subject at a time)
     dataset_config = cd.get_moabb_dataset_config(subjects_list)
     dataset = mb.BNCI2014001()
-    trials_per_subject, labels_per_subject, ch_list = download.get_moabb_data_handmade(dataset, dataset_config, 'train')
+    subjects_data = download.iterate_moabb_data_handmade(dataset, dataset_config, 'train')
     
-    for i in range(trials_per_subject.shape[0]):
+    for i, (trials, labels, ch_list) in enumerate(subjects_data):
         print("Subject: {}".format(subjects_list[i]))
 
-        trials = trials_per_subject[i]
-        labels = labels_per_subject[i]
-
         stft_trials_matrix, t, f = compute_stft(trials, dataset_config)
         stft_trials_matrix_ERS, t = compute_ERS(stft_trials_matrix, t, f)
 
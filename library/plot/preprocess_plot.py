@@ -66,33 +66,32 @@ def visualize_single_subject_average_channel_ERS(stft_data, label_list, ch_list,
     t = config['t']
     f = config['f']
     
-    # Create figure
-    fig, ax = plt.subplots(len(config['label_to_plot']), len(config['ch_to_plot']), figsize = config['figsize'])
+    # Create figure (with squeeze = False ax is always a 2D array, also with a single label or channel)
+    fig, ax = plt.subplots(len(config['label_to_plot']), len(config['ch_to_plot']), figsize = config['figsize'], squeeze = False)
     plt.rcParams.update({'font.size': config['fontsize']})
     
     # Name of the class labels
     label_legend = {1 : 'Left', 2 : 'Right', 3 : 'Foot'}
     label_legend = {0 : 'Left', 1 : 'Right', 2 : 'Foot'}
 
+    # Parameters shared by all the subplots
     if 'cmap' in config: cmap = config['cmap']
     else: cmap = None
+    vmin = config['vmin']
+    vmax = config['vmax'] 
+    titles = [["{} - {}".format(label_legend[label], ch) for ch in config['ch_to_plot']] for label in config['label_to_plot']]
 
-    for i in range(len(config['label_to_plot'])):
-        for j in range(len(config['ch_to_plot'])):
-            vmin = config['vmin']
-            vmax = config['vmax'] 
-            
+    for i in range(extracted_data.shape[0]):
+        for j in range(extracted_data.shape[1]):
             # Plot the stft
-            # im = ax[i, j].pcolormesh(t, f, extracted_data[i][j], shading='gouraud')
-            im = ax[i, j].pcolormesh(t, f, extracted_data[i][j], shading='gouraud', vmin = vmin, vmax = vmax, cmap = cmap)
+            # im = ax[i, j].pcolormesh(t, f, extracted_data[i, j], shading='gouraud')
+            im = ax[i, j].pcolormesh(t, f, extracted_data[i, j], shading='gouraud', vmin = vmin, vmax = vmax, cmap = cmap)
 
             # Label, title, limit  for each subplot
-            ax[i, j].set_ylabel('Frequency [Hz]')
-            ax[i, j].set_xlabel('Time [sec]')
-            ax[i, j].title.set_text("{} - {}".format(label_legend[config['label_to_plot'][i]], config['ch_to_plot'][j]))
+            ax[i, j].set(xlabel = 'Time [sec]', ylabel = 'Frequency [Hz]', title = titles[i][j])
             if 'y_limit' in config: ax[i, j].set_ylim(config['y_limit'])
     
-            fig.colorbar(im)
+            fig.colorbar(im, ax = ax[i, j])
 
     # Title for the figure and remove empty space
     fig.suptitle('Subject {}'.format(config['subject']))
@@ -110,26 +109,21 @@ def visualize_single_subject_average_channel_ERS(stft_data, label_list, ch_list,
 def extract_data_to_plot(data, ch_list, label_list, config):
     """
     Function that for each class and each channel compute the average trial (e.g. the average trial of class 'foot' for channel C3)
+    The output is a numpy array of shape L x C x ... with L = number of labels to plot and C = number of channels to plot
     """
-    # List of eeg data with specific channels and average along the class
-    extracted_data = []
-
-    for label in config['label_to_plot']:
-        # Get the indices of all the trial for a specific label
-        idx_label = label_list == label
-
-        # Get all the trial of the specific label and do the mean across the trial
-        # The results is a matrix of shape C x T that contain the average accross the trial for a specific class
-        average_per_label = data[idx_label].mean(0)
-        
-        # Get the channels that I want to plot
-        tmp_list = []
-        for ch in config['ch_to_plot']:
-            idx_ch = ch_list == ch
-            tmp_list.append(average_per_label[idx_ch].squeeze())
-        
-        # Save the list of data for the channels that I want to plot for this specific label
-        extracted_data.append(tmp_list)
+    # Get the indices of the channels that I want to plot
+    idx_ch = np.array([np.flatnonzero(ch_list == ch)[0] for ch in config['ch_to_plot']])
+
+    # Get the indices of all the trial for each label
+    idx_label_map = {label : np.flatnonzero(label_list == label) for label in config['label_to_plot']}
+    
+    # Matrix with the average trial for each class-channel that I want to plot
+    extracted_data = np.empty((len(config['label_to_plot']), len(idx_ch)) + data.shape[2:], dtype = data.dtype)
+
+    for i in range(len(config['label_to_plot'])):
+        # Get only the channels that I want to plot for all the trial of the specific label and do the mean across the trial
+        # N.b. with np.ix_ only the (trial, channel) blocks needed are copied (each block is contiguous in memory)
+        extracted_data[i] = data[np.ix_(idx_label_map[config['label_to_plot'][i]], idx_ch)].mean(0)
 
     return extracted_data 
 